@@ -1,17 +1,21 @@
 import streamlit as st
 import geopandas as gpd
-from shapely.geometry import box
-from shapely.ops import unary_union
 from shapely.geometry import mapping
-from pyproj import CRS
-import math, os, tempfile, zipfile
+from pyproj import CRS, Transformer
+import functools, io, json, math, os, tempfile, zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import shapely
 from streamlit_folium import st_folium
 import folium
 from fpdf import FPDF
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import contextily as ctx
 from lxml import etree
 import fiona
+from rasterio import features
+from rasterio.transform import from_origin
 
 # ================================================================
 # APP CONFIG + THEME
@@ -119,59 +123,257 @@ if generate_click:
         "beat_name": beat_name, "year_of_work": year_of_work
     }
     st.session_state["generated"] = True
+    st.session_state["prepared"] = set()
 
 # ================================================================
 # HELPERS
 # ================================================================
-def read_kml_safely(path):
-    """Robustly read KML using Fiona fallback."""
+def read_kml_safely(source):
+    """Robustly read KML from a path or raw bytes (pyogrio bulk reader, Fiona fallback)."""
     try:
-        return gpd.read_file(path, driver="KML")
+        return gpd.read_file(source, engine="pyogrio", driver="KML")
     except Exception:
+        # Fiona ships with its KML driver switched off and takes in-memory data as a file object
+        fiona.supported_drivers.setdefault("KML", "r")
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
         with fiona.Env():
-            return gpd.read_file(path, engine="fiona", driver="KML")
+            return gpd.read_file(source, engine="fiona", driver="KML")
+
+def _upload_kml_bytes(data, name):
+    """KML document bytes of an uploaded KML/KMZ (KMZ is unzipped in memory)."""
+    if name.lower().endswith(".kmz"):
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            kml = [f for f in z.namelist() if f.endswith(".kml")][0]
+            return z.read(kml)
+    return data
+
+def _feature_collection(geoms):
+    """GeoJSON FeatureCollection so a whole layer goes to folium as one GeoJson.
+
+    Geometry JSON is written by GEOS in one to_geojson call and parsed once.
+    """
+    geoms = np.asarray(list(geoms), dtype=object)
+    ids = np.flatnonzero(~shapely.is_empty(geoms))
+    geometries = json.loads("[" + ",".join(shapely.to_geojson(geoms[ids])) + "]")
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "properties": {"id": i}, "geometry": g}
+            for i, g in zip((ids + 1).tolist(), geometries)
+        ],
+    }
+
+def _preview_geoms(geoms, tolerance):
+    """Douglas-Peucker copies for the map preview only; KML/PDF exports keep full detail."""
+    return shapely.simplify(np.asarray(list(geoms), dtype=object), tolerance, preserve_topology=False)
 
 def utm_crs_for_lonlat(lon, lat):
     zone = int((lon + 180) / 6) + 1
     epsg = 32600 + zone if lat >= 0 else 32700 + zone
+    return _crs_from_epsg(epsg)
+
+@functools.lru_cache(maxsize=None)
+def _crs_from_epsg(epsg):
     return CRS.from_epsg(epsg)
 
+@functools.lru_cache(maxsize=None)
+def _transformer(src, dst):
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+def _run_chunked(func, arrays, min_len):
+    """Per-chunk results of ``func(*arrays)``: one call, or one slice per CPU on threads
+    once the arrays reach ``min_len`` (GEOS and PROJ both release the GIL)."""
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(arrays[0]) < min_len:
+        return [func(*arrays)]
+    chunks = zip(*(np.array_split(a, workers) for a in arrays))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda chunk: func(*chunk), chunks))
+
+# Coordinate arrays at least this long are reprojected on several threads
+PARALLEL_REPROJECT_MIN_COORDS = 200_000
+
+def reproject(geoms, src, dst):
+    """Reproject a geometry or geometry array with a cached pyproj Transformer."""
+    transformer = _transformer(src, dst)
+    def transform(*xyz):
+        parts = _run_chunked(transformer.transform, xyz, PARALLEL_REPROJECT_MIN_COORDS)
+        return tuple(np.concatenate(axis) for axis in zip(*parts))
+    return shapely.transform(geoms, transform, include_z=None, interleaved=False)
+
+# Grids at least this big are classified on a raster so only kept cells become polygons
+RASTER_GRID_MIN_CELLS = 250_000
+
+def _cell_polygons(x0, y0, size):
+    """Square cells from lower-left corner arrays (same ring as shapely box())."""
+    x1, y1 = x0 + size, y0 + size
+    ring_x = np.stack([x1, x1, x0, x0, x1], axis=1)
+    ring_y = np.stack([y0, y1, y1, y0, y0], axis=1)
+    return shapely.polygons(np.stack([ring_x, ring_y], axis=-1))
+
+def _classify_cells_raster(aoi, outline, minx, miny, cols, rows, size):
+    """Boundary / inside masks for every cell, burning the AOI and its outline at one pixel per cell."""
+    transform = from_origin(minx, miny + rows * size, size, size)
+    def burn(geom, all_touched):
+        mask = features.rasterize(
+            [(geom, 1)], out_shape=(rows, cols), transform=transform,
+            all_touched=all_touched, dtype="uint8",
+        )
+        return mask[::-1].T.ravel().astype(bool)  # north-up rows -> column-major cell order
+    boundary = burn(outline, True)
+    inside = ~boundary & burn(aoi, False)
+    return boundary, inside
+
+# Edge-cell batches at least this big are clipped on several threads
+PARALLEL_CLIP_MIN_CELLS = 4096
+
+def _clip_cells(cells, aoi):
+    """Intersect ``cells`` with ``aoi``, on threads for big batches.
+
+    A multi-part AOI is indexed in an STRtree so each cell is only clipped
+    against the parts it touches; cells spanning several parts are re-unioned.
+    """
+    parts = shapely.get_parts(aoi)
+    if len(parts) == 1:
+        return np.concatenate(_run_chunked(lambda c: shapely.intersection(c, aoi), (cells,), PARALLEL_CLIP_MIN_CELLS))
+    cell_idx, part_idx = shapely.STRtree(parts).query(cells, predicate="intersects")
+    pieces = np.concatenate(_run_chunked(
+        shapely.intersection, (cells[cell_idx], parts[part_idx]), PARALLEL_CLIP_MIN_CELLS
+    ))
+    clipped = np.full(len(cells), shapely.Polygon(), dtype=object)
+    starts = np.flatnonzero(np.r_[True, np.diff(cell_idx) != 0])  # query output is sorted by cell
+    counts = np.diff(np.r_[starts, len(cell_idx)])
+    single = starts[counts == 1]
+    clipped[cell_idx[single]] = pieces[single]
+    for start, count in zip(starts[counts > 1], counts[counts > 1]):
+        clipped[cell_idx[start]] = shapely.union_all(pieces[start:start + count])
+    return clipped
+
+def _polygonal_only(geoms):
+    """Drop empty and line/point results of clipping; mixed collections keep their polygons."""
+    type_id = shapely.get_type_id(geoms)
+    for i in np.flatnonzero(type_id == 7):  # GeometryCollection (rare: edge-touch leftovers)
+        parts = shapely.get_parts(geoms[i])
+        geoms[i] = shapely.union_all(parts[shapely.get_type_id(parts) == 3])
+        type_id[i] = shapely.get_type_id(geoms[i])
+    return geoms[np.isin(type_id, (3, 6)) & ~shapely.is_empty(geoms)]
+
 def make_grid_exact_clipped(polygons_ll, cell_size_m=100):
-    merged_ll = unary_union(polygons_ll)
+    polygons_ll = list(polygons_ll)
+    # A single valid (Multi)Polygon is already its own union
+    if len(polygons_ll) == 1 and polygons_ll[0].geom_type in ("Polygon", "MultiPolygon") and polygons_ll[0].is_valid:
+        merged_ll = polygons_ll[0]
+    else:
+        # Only polygons are gridded: pins or paths in the AOI file would turn the union
+        # into a GeometryCollection, whose boundary is None and finds no edge cells
+        parts = shapely.get_parts(np.asarray(polygons_ll, dtype=object))
+        merged_ll = shapely.union_all(parts[np.isin(shapely.get_type_id(parts), (3, 6))])
     centroid = merged_ll.centroid
     utm = utm_crs_for_lonlat(centroid.x, centroid.y)
-    merged_utm = gpd.GeoSeries([merged_ll], crs=4326).to_crs(utm)
-    minx, miny, maxx, maxy = merged_utm.total_bounds
+    aoi_union = reproject(merged_ll, 4326, utm)
+    minx, miny, maxx, maxy = aoi_union.bounds
     cols, rows = int(math.ceil((maxx - minx) / cell_size_m)), int(math.ceil((maxy - miny) / cell_size_m))
-    cells = []
-    aoi_union = merged_utm.unary_union
-    for i in range(cols):
-        for j in range(rows):
-            x0, y0 = minx + i * cell_size_m, miny + j * cell_size_m
-            cell = box(x0, y0, x0 + cell_size_m, y0 + cell_size_m)
-            inter = cell.intersection(aoi_union)
-            if not inter.is_empty:
-                cells.append(inter)
-    cells_ll = [gpd.GeoSeries([c], crs=utm).to_crs(4326).iloc[0] for c in cells]
-    return cells_ll, merged_ll
+
+    # Lower-left corners of every candidate cell (column-major, like the old i/j loop)
+    x0, y0 = np.meshgrid(
+        minx + np.arange(cols) * cell_size_m,
+        miny + np.arange(rows) * cell_size_m,
+        indexing="ij",
+    )
+    x0, y0 = x0.ravel(), y0.ravel()
+
+    # Only cells crossed by the AOI outline need clipping; every other cell is
+    # wholly inside or outside, which a point-in-polygon test on its centre settles.
+    # Both paths take the same polygonal AOI and outline so they classify alike.
+    outline = aoi_union.boundary
+    if cols * rows >= RASTER_GRID_MIN_CELLS:
+        boundary, inside = _classify_cells_raster(aoi_union, outline, minx, miny, cols, rows, cell_size_m)
+    else:
+        grid = _cell_polygons(x0, y0, cell_size_m)
+        boundary = np.zeros(len(grid), dtype=bool)
+        boundary[shapely.STRtree(grid).query(outline, predicate="intersects")] = True
+        shapely.prepare(aoi_union)
+        inside = ~boundary & shapely.contains_xy(aoi_union, x0 + cell_size_m / 2, y0 + cell_size_m / 2)
+
+    keep = inside | boundary
+    cells = _cell_polygons(x0[keep], y0[keep], cell_size_m)
+    on_edge = boundary[keep]
+    cells[on_edge] = _clip_cells(cells[on_edge], aoi_union)
+    cells = _polygonal_only(cells)
+    areas_ha = shapely.area(cells) / 10000.0  # exact UTM areas, before going back to lon/lat
+    cells_ll = list(reproject(cells, utm, 4326))
+    return cells_ll, merged_ll, areas_ha
 
 # ================================================================
 # KML GENERATORS (with Description + Balloon Popups)
 # ================================================================
-def _ring_coords_to_kml(ring):
-    return " ".join(f"{pt[0]},{pt[1]},0" for pt in ring.coords if len(pt) >= 2)
-
-def _write_polygon_coords(ns, parent_polygon_elem, geom):
-    def write_one(poly):
-        outer = etree.SubElement(parent_polygon_elem, "{%s}outerBoundaryIs" % ns)
-        lr_out = etree.SubElement(outer, "{%s}LinearRing" % ns)
-        etree.SubElement(lr_out, "{%s}coordinates" % ns).text = _ring_coords_to_kml(poly.exterior)
+KML_NS = "http://www.opengis.net/kml/2.2"
+
+def _q(tag):
+    return "{%s}%s" % (KML_NS, tag)
+
+# Namespaced tag names, built once instead of per element
+_Q_KML = _q("kml")
+_Q_DOCUMENT = _q("Document")
+_Q_NAME = _q("name")
+_Q_DESCRIPTION = _q("description")
+_Q_STYLE = _q("Style")
+_Q_LINE_STYLE = _q("LineStyle")
+_Q_COLOR = _q("color")
+_Q_WIDTH = _q("width")
+_Q_POLY_STYLE = _q("PolyStyle")
+_Q_FILL = _q("fill")
+_Q_BALLOON_STYLE = _q("BalloonStyle")
+_Q_TEXT = _q("text")
+_Q_PLACEMARK = _q("Placemark")
+_Q_STYLE_URL = _q("styleUrl")
+_Q_MULTI_GEOMETRY = _q("MultiGeometry")
+_Q_POLYGON = _q("Polygon")
+_Q_OUTER_BOUNDARY_IS = _q("outerBoundaryIs")
+_Q_LINEAR_RING = _q("LinearRing")
+_Q_COORDINATES = _q("coordinates")
+
+# Decimal places kept for lon/lat in KML (1e-7 deg is about 1 cm on the ground)
+KML_DECIMALS = 7
+_KML_POINT_FORMAT = "{0[0]:.%df},{0[1]:.%df},0" % (KML_DECIMALS, KML_DECIMALS)
+
+def _ring_coords_to_kml(rings):
+    """KML coordinate text for each ring, formatted in one batch.
+
+    Coordinates are written as plain decimals with KML_DECIMALS places (~1 cm),
+    so values near zero never come out in exponent form.
+    """
+    coords, idx = shapely.get_coordinates(rings, return_index=True)
+    pts = list(map(_KML_POINT_FORMAT.format, coords.tolist()))
+    ends = np.searchsorted(idx, np.arange(len(rings)), side="right")
+    return [" ".join(pts[a:b]) for a, b in zip(np.r_[0, ends[:-1]], ends)]
+
+def _exterior_ring_texts(geoms):
+    """Coordinate text of every polygon part's exterior ring, grouped per geometry."""
+    parts, idx = shapely.get_parts(np.asarray(geoms, dtype=object), return_index=True)
+    texts = _ring_coords_to_kml(shapely.get_exterior_ring(parts))
+    bounds = np.searchsorted(idx, np.arange(len(geoms) + 1))
+    return [texts[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+def _write_text(xf, tag, text, **attrib):
+    with xf.element(tag, **attrib):
+        xf.write(text)
+
+def _write_polygon_coords(xf, geom, ring_texts=None):
+    if ring_texts is None:
+        ring_texts = _exterior_ring_texts([geom])[0]
+    def write_one(text):
+        with xf.element(_Q_POLYGON):
+            with xf.element(_Q_OUTER_BOUNDARY_IS):
+                with xf.element(_Q_LINEAR_RING):
+                    _write_text(xf, _Q_COORDINATES, text)
     if geom.geom_type == "Polygon":
-        write_one(geom)
+        write_one(ring_texts[0])
     elif geom.geom_type == "MultiPolygon":
-        for part in geom.geoms:
-            poly_elem = etree.SubElement(parent_polygon_elem.getparent(), "{%s}Polygon" % ns)
-            write_one(part)
+        with xf.element(_Q_MULTI_GEOMETRY):
+            for text in ring_texts:
+                write_one(text)
 
 def _make_grid_balloon_text(user_inputs):
     return (
@@ -186,121 +388,183 @@ def _make_grid_balloon_text(user_inputs):
         "]]>"
     )
 
-def generate_grid_only_kml(cells_ll, merged_ll, user_inputs):
-    """Grid-only KML with same popup label as merged (no overlay)."""
-    ns = "http://www.opengis.net/kml/2.2"
-    kml = etree.Element("{%s}kml" % ns)
-    doc = etree.SubElement(kml, "{%s}Document" % ns)
-
-    etree.SubElement(doc, "{%s}name" % ns).text = "Grid Only"
-    etree.SubElement(doc, "{%s}description" % ns).text = (
-        "Grid-only file with labeled cells for field use. "
-        "Developed by Krishna (Thammampatti Range)."
+def _write_line_style(xf, style_id, color, width, balloon_text=None):
+    with xf.element(_Q_STYLE, id=style_id):
+        with xf.element(_Q_LINE_STYLE):
+            _write_text(xf, _Q_COLOR, color)
+            _write_text(xf, _Q_WIDTH, width)
+        with xf.element(_Q_POLY_STYLE):
+            _write_text(xf, _Q_FILL, "0")
+        if balloon_text is not None:
+            with xf.element(_Q_BALLOON_STYLE):
+                _write_text(xf, _Q_TEXT, balloon_text)
+
+# Serialized form of what _write_polygon_coords emits; grid text is only digits, so no escaping
+_POLYGON_TMPL = (
+    "<Polygon><outerBoundaryIs><LinearRing><coordinates>{}</coordinates>"
+    "</LinearRing></outerBoundaryIs></Polygon>"
+)
+_GRID_PLACEMARK_TMPL = (
+    "<Placemark><name>{i}</name><styleUrl>#gridStyle</styleUrl>"
+    '<ExtendedData><Data name="area_ha"><value>{area}</value></Data></ExtendedData>'
+    "<description>Grid {i} — Area: {area} ha</description>{geometry}</Placemark>"
+)
+
+def _polygon_kml(geom_type, ring_texts):
+    if geom_type == 3:  # Polygon
+        return _POLYGON_TMPL.format(ring_texts[0])
+    if geom_type == 6:  # MultiPolygon
+        return "<MultiGeometry>" + "".join(map(_POLYGON_TMPL.format, ring_texts)) + "</MultiGeometry>"
+    return ""
+
+def _write_grid_placemarks(xf, out, cells_ll, areas_ha):
+    """Grid placemarks are filled into a string template and written straight to ``out``,
+    the stream under ``xf``; building ~10 lxml elements per cell dominated large grids."""
+    ring_texts = _exterior_ring_texts(cells_ll)
+    type_ids = shapely.get_type_id(np.asarray(cells_ll, dtype=object)).tolist()
+    # Range/RF/Beat/Year live once in the shared BalloonStyle; per cell only ID + area vary
+    area_texts = map("{:.2f}".format, np.asarray(areas_ha).tolist())
+    placemarks = "".join(
+        _GRID_PLACEMARK_TMPL.format(i=i, area=area, geometry=_polygon_kml(type_id, texts))
+        for i, (type_id, texts, area) in enumerate(zip(type_ids, ring_texts, area_texts), 1)
     )
+    xf.flush()
+    out.write(placemarks.encode("utf-8"))
+
+# KML text above this size is offered as a deflated KMZ instead
+KMZ_MIN_BYTES = 1_000_000
+
+def kml_download(kml_text, stem):
+    """(data, file_name, mime) for a download button; large KMLs are zipped as doc.kml."""
+    data = kml_text.encode("utf-8")
+    if len(data) < KMZ_MIN_BYTES:
+        return data, f"{stem}.kml", "application/vnd.google-earth.kml+xml"
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        zf.writestr("doc.kml", data)
+    return buf.getvalue(), f"{stem}.kmz", "application/vnd.google-earth.kmz"
+
+def generate_grid_only_kml(cells_ll, areas_ha, user_inputs):
+    """Grid-only KML with same popup label as merged (no overlay)."""
+    buf = io.BytesIO()
+    with etree.xmlfile(buf, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(_Q_KML, nsmap={None: KML_NS}):
+            with xf.element(_Q_DOCUMENT):
+                _write_text(xf, _Q_NAME, "Grid Only")
+                _write_text(xf, _Q_DESCRIPTION, (
+                    "Grid-only file with labeled cells for field use. "
+                    "Developed by Krishna (Thammampatti Range)."
+                ))
 
-    style_grid = etree.SubElement(doc, "{%s}Style" % ns, id="gridStyle")
-    ls1 = etree.SubElement(style_grid, "{%s}LineStyle" % ns)
-    etree.SubElement(ls1, "{%s}color" % ns).text = "ff0000ff"  # red
-    etree.SubElement(ls1, "{%s}width" % ns).text = "1"
-    ps1 = etree.SubElement(style_grid, "{%s}PolyStyle" % ns)
-    etree.SubElement(ps1, "{%s}fill" % ns).text = "0"
-    balloon = etree.SubElement(style_grid, "{%s}BalloonStyle" % ns)
-    etree.SubElement(balloon, "{%s}text" % ns).text = _make_grid_balloon_text(user_inputs)
+                _write_line_style(xf, "gridStyle", "ff0000ff", "1",  # red
+                                  balloon_text=_make_grid_balloon_text(user_inputs))
 
-    for i, cell in enumerate(cells_ll, 1):
-        centroid = cell.centroid
-        utm_crs = utm_crs_for_lonlat(centroid.x, centroid.y)
-        area_ha = gpd.GeoSeries([cell], crs=4326).to_crs(utm_crs).area.iloc[0] / 10000.0
+                _write_grid_placemarks(xf, buf, cells_ll, areas_ha)
 
-        pm = etree.SubElement(doc, "{%s}Placemark" % ns)
-        etree.SubElement(pm, "{%s}name" % ns).text = str(i)
-        etree.SubElement(pm, "{%s}styleUrl" % ns).text = "#gridStyle"
+    return buf.getvalue().decode("utf-8")
 
-        ext_data = etree.SubElement(pm, "{%s}ExtendedData" % ns)
-        d = etree.SubElement(ext_data, "{%s}Data" % ns, name="area_ha")
-        etree.SubElement(d, "{%s}value" % ns).text = f"{area_ha:.2f}"
+def generate_labeled_kml(cells_ll, areas_ha, user_inputs, overlay_gdf=None):
+    """Labeled grid + overlay (gold) with popups and description."""
+    buf = io.BytesIO()
+    with etree.xmlfile(buf, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(_Q_KML, nsmap={None: KML_NS}):
+            with xf.element(_Q_DOCUMENT):
+                _write_text(xf, _Q_NAME, "Labeled Grid + Overlay")
+                _write_text(xf, _Q_DESCRIPTION, (
+                    "Labeled grid with overlay boundary. "
+                    "Developed by Krishna (Thammampatti Range)."
+                ))
+
+                # Grid style (red 1px) + overlay style (golden yellow 3px, ABGR for #FFD700)
+                _write_line_style(xf, "gridStyle", "ff0000ff", "1",
+                                  balloon_text=_make_grid_balloon_text(user_inputs))
+                _write_line_style(xf, "overlayStyle", "ff00d7ff", "3")
+
+                # Grid placemarks
+                _write_grid_placemarks(xf, buf, cells_ll, areas_ha)
+
+                # Overlay boundary
+                if overlay_gdf is not None and not overlay_gdf.empty:
+                    og = overlay_gdf.to_crs(4326)
+                    for geom in og.geometry:
+                        if geom.is_empty:
+                            continue
+                        with xf.element(_Q_PLACEMARK):
+                            _write_text(xf, _Q_NAME, "Overlay Boundary")
+                            _write_text(xf, _Q_STYLE_URL, "#overlayStyle")
+                            _write_polygon_coords(xf, geom)
+
+    return buf.getvalue().decode("utf-8")
 
-        desc = etree.SubElement(pm, "{%s}description" % ns)
-        desc.text = f"Grid {i} — Area: {area_ha:.2f} ha"
+# ================================================================
+# PDF REPORT FUNCTION (stable layout + correct footer)
+# ================================================================
+def _ring_vertex_arrays(geoms):
+    """Vertices of every polygon ring in ``geoms`` as separate (n, 2) arrays."""
+    rings = shapely.get_rings(shapely.get_parts(np.asarray(geoms, dtype=object)))
+    coords, idx = shapely.get_coordinates(rings, return_index=True)
+    return np.split(coords, np.flatnonzero(np.diff(idx)) + 1)
+
+def _render_tight(fig, dpi, pad_inches=0.1):
+    """Draw ``fig`` on its Agg canvas at ``dpi`` and return an RGB PIL image,
+    cropped like savefig(bbox_inches="tight") but without a PNG round-trip."""
+    from PIL import Image
+    fig.set_dpi(dpi)
+    fig.canvas.draw()
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(pad_inches)
+    width, height = fig.canvas.get_width_height()
+    crop = (
+        max(0, int(bbox.x0 * dpi)), max(0, int(height - bbox.y1 * dpi)),
+        min(width, int(math.ceil(bbox.x1 * dpi))), min(height, int(math.ceil(height - bbox.y0 * dpi))),
+    )
+    return Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).convert("RGB").crop(crop)
 
-        poly = etree.SubElement(pm, "{%s}Polygon" % ns)
-        _write_polygon_coords(ns, poly, cell)
+# Keep basemap tiles on disk across sessions/restarts (contextily's default
+# cache is a throwaway temp dir per process)
+ctx.set_cache_dir(os.path.join(tempfile.gettempdir(), "ctx_tile_cache"))
 
-    return etree.tostring(kml, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("utf-8")
+@functools.lru_cache(maxsize=8)
+def _basemap_image(west, south, east, north):
+    """Esri imagery mosaic for a Web-Mercator extent; repeat renders skip tile decoding."""
+    return ctx.bounds2img(west, south, east, north, source=ctx.providers.Esri.WorldImagery)
 
-def generate_labeled_kml(cells_ll, merged_ll, user_inputs, overlay_gdf=None):
-    """Labeled grid + overlay (gold) with popups and description."""
-    ns = "http://www.opengis.net/kml/2.2"
-    kml = etree.Element("{%s}kml" % ns)
-    doc = etree.SubElement(kml, "{%s}Document" % ns)
-
-    etree.SubElement(doc, "{%s}name" % ns).text = "Labeled Grid + Overlay"
-    etree.SubElement(doc, "{%s}description" % ns).text = (
-        "Labeled grid with overlay boundary. "
-        "Developed by Krishna (Thammampatti Range)."
-    )
+def render_report_map(cells_ll, merged_ll, overlay_gdf=None):
+    """Satellite map of the AOI (red 3px), grid (red 1px) and overlay (gold 3px) as JPEG bytes.
 
-    # Grid style
-    style_grid = etree.SubElement(doc, "{%s}Style" % ns, id="gridStyle")
-    ls1 = etree.SubElement(style_grid, "{%s}LineStyle" % ns)
-    etree.SubElement(ls1, "{%s}color" % ns).text = "ff0000ff"  # red
-    etree.SubElement(ls1, "{%s}width" % ns).text = "1"
-    ps1 = etree.SubElement(style_grid, "{%s}PolyStyle" % ns)
-    etree.SubElement(ps1, "{%s}fill" % ns).text = "0"
-    balloon = etree.SubElement(style_grid, "{%s}BalloonStyle" % ns)
-    etree.SubElement(balloon, "{%s}text" % ns).text = _make_grid_balloon_text(user_inputs)
-
-    # Overlay style (golden yellow 3px)
-    style_overlay = etree.SubElement(doc, "{%s}Style" % ns, id="overlayStyle")
-    ls2 = etree.SubElement(style_overlay, "{%s}LineStyle" % ns)
-    etree.SubElement(ls2, "{%s}color" % ns).text = "ff00d7ff"  # ABGR for #FFD700
-    etree.SubElement(ls2, "{%s}width" % ns).text = "3"
-    ps2 = etree.SubElement(style_overlay, "{%s}PolyStyle" % ns)
-    etree.SubElement(ps2, "{%s}fill" % ns).text = "0"
-
-    # Grid placemarks
-    for i, cell in enumerate(cells_ll, 1):
-        centroid = cell.centroid
-        utm_crs = utm_crs_for_lonlat(centroid.x, centroid.y)
-        area_ha = gpd.GeoSeries([cell], crs=4326).to_crs(utm_crs).area.iloc[0] / 10000.0
-
-        pm = etree.SubElement(doc, "{%s}Placemark" % ns)
-        etree.SubElement(pm, "{%s}name" % ns).text = str(i)
-        etree.SubElement(pm, "{%s}styleUrl" % ns).text = "#gridStyle"
-
-        ext_data = etree.SubElement(pm, "{%s}ExtendedData" % ns)
-        d = etree.SubElement(ext_data, "{%s}Data" % ns, name="area_ha")
-        etree.SubElement(d, "{%s}value" % ns).text = f"{area_ha:.2f}"
-
-        desc = etree.SubElement(pm, "{%s}description" % ns)
-        desc.text = f"Grid {i} — Area: {area_ha:.2f} ha"
-
-        poly = etree.SubElement(pm, "{%s}Polygon" % ns)
-        _write_polygon_coords(ns, poly, cell)
-
-    # Overlay boundary
+    The map is mostly photographic imagery, so a 150 dpi JPEG (~150 dpi at its
+    180 mm width on the page) is embedded by fpdf as-is, unlike a re-compressed PNG.
+    """
+    fig, ax = plt.subplots(figsize=(7, 5.8))
+    merged_3857 = reproject(np.asarray([merged_ll], dtype=object), 4326, 3857)
+    grid_3857 = reproject(np.asarray(cells_ll, dtype=object), 4326, 3857)
+    # Each layer is one LineCollection of ring vertex arrays (no per-geometry artists)
+    ax.add_collection(LineCollection(_ring_vertex_arrays(merged_3857), colors="red", linewidths=3))  # AOI 3px red
+    ax.add_collection(LineCollection(_ring_vertex_arrays(grid_3857), colors="red", linewidths=1))    # Grid 1px red
     if overlay_gdf is not None and not overlay_gdf.empty:
-        og = overlay_gdf.to_crs(4326)
-        for geom in og.geometry:
-            if geom.is_empty:
-                continue
-            pm = etree.SubElement(doc, "{%s}Placemark" % ns)
-            etree.SubElement(pm, "{%s}name" % ns).text = "Overlay Boundary"
-            etree.SubElement(pm, "{%s}styleUrl" % ns).text = "#overlayStyle"
-            poly = etree.SubElement(pm, "{%s}Polygon" % ns)
-            _write_polygon_coords(ns, poly, geom)
-
-    return etree.tostring(kml, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("utf-8")
+        ax.add_collection(LineCollection(
+            _ring_vertex_arrays(reproject(overlay_gdf.geometry.to_numpy(), overlay_gdf.crs, 3857)), colors="#FFD700", linewidths=3
+        ))  # Overlay gold 3px
+    ax.set_aspect("equal"); ax.autoscale_view()
+    xmin, xmax, ymin, ymax = ax.axis()
+    basemap, extent = _basemap_image(xmin, ymin, xmax, ymax)
+    ax.imshow(basemap, extent=extent, interpolation="bilinear", aspect=ax.get_aspect())
+    ax.axis((xmin, xmax, ymin, ymax))
+    ctx.add_attribution(ax, ctx.providers.Esri.WorldImagery.attribution)
+    ax.axis("off"); plt.tight_layout(pad=0.1)
+    image = _render_tight(fig, dpi=150); plt.close(fig)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=85, optimize=True)
+    return buf.getvalue()
 
-# ================================================================
-# PDF REPORT FUNCTION (stable layout + correct footer)
-# ================================================================
 def build_pdf_report_standard(
     cells_ll, merged_ll, user_inputs, cell_size,
-    overlay_gdf, title_text, density, area_invasive
+    overlay_gdf, title_text, density, area_invasive, map_image=None
 ):
-    import geopandas as gpd, matplotlib.pyplot as plt, contextily as ctx, tempfile, os
+    import os
     from fpdf import FPDF
+    from fpdf.fonts import FontFace
 
     MAP_X, MAP_Y, MAP_W, MAP_H, LEGEND_GAP = 15, 55, 180, 145, 8
     EMBLEM_PATH = os.path.join(os.path.dirname(__file__), "tn_emblem.png")
@@ -326,19 +590,9 @@ def build_pdf_report_standard(
     pdf.cell(0, 8, title_text, ln=1, align="C")
 
     # Map image
-    tmp_dir = tempfile.gettempdir()
-    map_img = os.path.join(tmp_dir, "map_overlay.png")
-    fig, ax = plt.subplots(figsize=(7, 5.8))
-    merged_gdf = gpd.GeoSeries([merged_ll], crs="EPSG:4326").to_crs(3857)
-    grid_gdf = gpd.GeoSeries(cells_ll, crs="EPSG:4326").to_crs(3857)
-    merged_gdf.boundary.plot(ax=ax, color="red", linewidth=3)            # AOI 3px red
-    grid_gdf.boundary.plot(ax=ax, color="red", linewidth=1)              # Grid 1px red
-    if overlay_gdf is not None and not overlay_gdf.empty:
-        overlay_gdf.to_crs(3857).boundary.plot(ax=ax, color="#FFD700", linewidth=3)  # Overlay gold 3px
-    ctx.add_basemap(ax, crs=3857, source=ctx.providers.Esri.WorldImagery)  # do not pass attribution kw
-    ax.axis("off"); plt.tight_layout(pad=0.1)
-    fig.savefig(map_img, dpi=250, bbox_inches="tight"); plt.close(fig)
-    pdf.image(map_img, x=MAP_X, y=MAP_Y, w=MAP_W, h=MAP_H)
+    if map_image is None:
+        map_image = render_report_map(cells_ll, merged_ll, overlay_gdf)
+    pdf.image(io.BytesIO(map_image), x=MAP_X, y=MAP_Y, w=MAP_W, h=MAP_H)
 
     # Legend
     legend_y = MAP_Y + MAP_H + LEGEND_GAP
@@ -358,9 +612,10 @@ def build_pdf_report_standard(
         f"Cell Size: {cell_size} m",
         f"Overlay: {'Yes' if overlay_gdf is not None and not overlay_gdf.empty else 'No'}",
     ]
-    for i in range(4):
-        pdf.text(MAP_X + 10, legend_y + 10 + i * 6, col1[i])
-        pdf.text(MAP_X + 100, legend_y + 10 + i * 6, col2[i])
+    # One multi_cell per column; 6mm lines put the first baseline at legend_y + 10
+    for x, lines in ((MAP_X + 9, col1), (MAP_X + 99, col2)):
+        pdf.set_xy(x, legend_y + 6)
+        pdf.multi_cell(85, 6, "\n".join(lines))
 
     # Note
     pdf.set_y(legend_y + 47)
@@ -373,37 +628,28 @@ def build_pdf_report_standard(
         pdf.add_page()
         pdf.set_font("Helvetica", "B", 12)
         pdf.cell(0, 10, "Corner GPS of Overlay Area", ln=1, align="C")
-        pdf.set_font("Helvetica", "B", 11)
-        pdf.cell(25, 8, "S.No", 1, align="C")
-        pdf.cell(75, 8, "Latitude", 1, align="C")
-        pdf.cell(75, 8, "Longitude", 1, align="C"); pdf.ln(8)
         pdf.set_font("Helvetica", "", 10)
 
-        row = 1
         overlay = overlay_gdf.to_crs(4326)
-        for geom in overlay.geometry:
-            if geom.is_empty:
-                continue
-            coords = []
-            if geom.geom_type == "Polygon":
-                coords = list(geom.exterior.coords)
-            elif geom.geom_type == "MultiPolygon":
-                for part in geom.geoms:
-                    coords.extend(list(part.exterior.coords))
-            for lon, lat, *_ in coords:
-                pdf.cell(25, 7, str(row), 1)
-                pdf.cell(75, 7, f"{lat:.6f}", 1, align="R")
-                pdf.cell(75, 7, f"{lon:.6f}", 1, align="R")
-                pdf.ln(7)
-                row += 1
-                if pdf.get_y() > 265:
-                    pdf.add_page()
-                    pdf.set_font("Helvetica", "B", 11)
-                    pdf.cell(25, 8, "S.No", 1, align="C")
-                    pdf.cell(75, 8, "Latitude", 1, align="C")
-                    pdf.cell(75, 8, "Longitude", 1, align="C")
-                    pdf.ln(8)
-                    pdf.set_font("Helvetica", "", 10)
+        # One fpdf2 table; it repeats the heading row itself on every new page.
+        # Table cells are painted with the current fill colour, so undo the legend's tint.
+        pdf.set_fill_color(255, 255, 255)
+        with pdf.table(
+            width=175, col_widths=(25, 75, 75), align="LEFT", line_height=7,
+            text_align=("LEFT", "RIGHT", "RIGHT"),
+            headings_style=FontFace(emphasis="BOLD", size_pt=11),
+        ) as table:
+            headings = table.row()
+            for heading in ("S.No", "Latitude", "Longitude"):
+                headings.cell(heading, align="CENTER")
+            # Exterior-ring vertices of every (Multi)Polygon part, pulled out in one batch
+            geoms = overlay.geometry.to_numpy()
+            geoms = geoms[np.isin(shapely.get_type_id(geoms), (3, 6))]
+            coords = shapely.get_coordinates(shapely.get_exterior_ring(shapely.get_parts(geoms)))
+            lats = map("{:.6f}".format, coords[:, 1].tolist())
+            lons = map("{:.6f}".format, coords[:, 0].tolist())
+            for row, lat, lon in zip(range(1, len(coords) + 1), lats, lons):
+                table.row((str(row), lat, lon))
 
     # Output bytes
     result = pdf.output(dest="S")
@@ -432,31 +678,66 @@ cell_size = st.session_state.get("cell_size", cell_size)
 # CACHED OUTPUT GENERATOR
 # ================================================================
 @st.cache_data(show_spinner=False)
-def generate_all_outputs(aoi_path, overlay_path, user_inputs, cell_size, title_text, density, area_invasive):
-    gdf = read_kml_safely(aoi_path)
-    polygons = gdf.geometry
-    cells_ll, merged_ll = make_grid_exact_clipped(polygons, cell_size)
-
-    overlay_gdf = None
-    if overlay_path:
-        overlay_gdf = read_kml_safely(overlay_path).to_crs(4326)
-
-    grid_only_kml = generate_grid_only_kml(cells_ll, merged_ll, user_inputs)
-    labeled_kml = generate_labeled_kml(cells_ll, merged_ll, user_inputs, overlay_gdf)
-    pdf_bytes = build_pdf_report_standard(
-        cells_ll, merged_ll, user_inputs, cell_size, overlay_gdf,
-        title_text, density, area_invasive
-    )
+def _parse_and_grid(aoi_bytes, aoi_name, cell_size):
+    """Read the AOI upload and build the clipped grid, cached on the file bytes.
+
+    Geometries are returned as WKB so the cached value stays cheap to pickle.
+    """
+    gdf = read_kml_safely(_upload_kml_bytes(aoi_bytes, aoi_name))
+    cells_ll, merged_ll, areas_ha = make_grid_exact_clipped(gdf.geometry, cell_size)
+    return shapely.to_wkb(np.asarray(cells_ll, dtype=object)), shapely.to_wkb(merged_ll), areas_ha
+
+def _grid_geometries(aoi_bytes, aoi_name, cell_size):
+    cells_wkb, merged_wkb, areas_ha = _parse_and_grid(aoi_bytes, aoi_name, cell_size)
+    return list(shapely.from_wkb(cells_wkb)), shapely.from_wkb(merged_wkb), areas_ha
+
+@st.cache_data(show_spinner=False)
+def _read_overlay(overlay_bytes, overlay_name):
+    if not overlay_bytes:
+        return None
+    return read_kml_safely(_upload_kml_bytes(overlay_bytes, overlay_name)).to_crs(4326)
+
+# Not cached itself: its inputs already are, and caching the decoded cells would
+# pickle every geometry instead of the WKB kept by _parse_and_grid
+def generate_all_outputs(aoi_bytes, aoi_name, overlay_bytes, overlay_name, cell_size):
+    cells_ll, merged_ll, _ = _grid_geometries(aoi_bytes, aoi_name, cell_size)
+    overlay_gdf = _read_overlay(overlay_bytes, overlay_name)
 
     return {
-        "grid_only_kml": grid_only_kml,
-        "labeled_kml": labeled_kml,
-        "pdf_bytes": pdf_bytes,
         "overlay_gdf": overlay_gdf,
         "cells_ll": cells_ll,
         "merged_ll": merged_ll,
     }
 
+# KMLs and the PDF are only built once the user asks for them (then cached like the rest)
+@st.cache_data(show_spinner=False)
+def grid_only_kml_output(aoi_bytes, aoi_name, user_inputs, cell_size):
+    cells_ll, _, areas_ha = _grid_geometries(aoi_bytes, aoi_name, cell_size)
+    return kml_download(generate_grid_only_kml(cells_ll, areas_ha, user_inputs), "grid_only")
+
+@st.cache_data(show_spinner=False)
+def labeled_kml_output(aoi_bytes, aoi_name, overlay_bytes, overlay_name, user_inputs, cell_size):
+    cells_ll, _, areas_ha = _grid_geometries(aoi_bytes, aoi_name, cell_size)
+    overlay_gdf = _read_overlay(overlay_bytes, overlay_name)
+    kml = generate_labeled_kml(cells_ll, areas_ha, user_inputs, overlay_gdf)
+    return kml_download(kml, "merged_labeled")
+
+@st.cache_data(show_spinner=False)
+def _report_map_output(aoi_bytes, aoi_name, overlay_bytes, overlay_name, cell_size):
+    """Report map image; cached apart from the PDF so editing report text doesn't redraw it."""
+    cells_ll, merged_ll, _ = _grid_geometries(aoi_bytes, aoi_name, cell_size)
+    return render_report_map(cells_ll, merged_ll, _read_overlay(overlay_bytes, overlay_name))
+
+@st.cache_data(show_spinner=False)
+def pdf_report_output(aoi_bytes, aoi_name, overlay_bytes, overlay_name,
+                      user_inputs, cell_size, title_text, density, area_invasive):
+    cells_ll, merged_ll, _ = _grid_geometries(aoi_bytes, aoi_name, cell_size)
+    map_image = _report_map_output(aoi_bytes, aoi_name, overlay_bytes, overlay_name, cell_size)
+    return build_pdf_report_standard(
+        cells_ll, merged_ll, user_inputs, cell_size, _read_overlay(overlay_bytes, overlay_name),
+        title_text, density, area_invasive, map_image
+    )
+
 # 2️⃣ Only execute heavy logic if user pressed Generate
 if generate_click:
     st.session_state["generated"] = True
@@ -465,43 +746,18 @@ if generate_click:
 if st.session_state.get("generated", False):
 
     st.success("✅ Grid successfully generated! Scroll below to preview map and downloads.")
-    aoi_path, ov_path = None, None
-
-    # Handle AOI (required)
-    if uploaded_aoi:
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(uploaded_aoi.read())
-            aoi_path = tmp.name
-        if uploaded_aoi.name.lower().endswith(".kmz"):
-            with zipfile.ZipFile(aoi_path) as z:
-                kml = [f for f in z.namelist() if f.endswith(".kml")][0]
-                aoi_path = os.path.join(tempfile.gettempdir(), "aoi.kml")
-                with open(aoi_path, "wb") as f:
-                    f.write(z.read(kml))
-    else:
+
+    # AOI is required; overlay is optional
+    if not uploaded_aoi:
         st.warning("⚠️ Please upload an AOI file before generating.")
         st.stop()
 
-    # Handle Overlay (optional)
-    if overlay_file:
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(overlay_file.read())
-            ov_path = tmp.name
-        if overlay_file.name.lower().endswith(".kmz"):
-            with zipfile.ZipFile(ov_path) as z:
-                kml = [f for f in z.namelist() if f.endswith(".kml")][0]
-                ov_path = os.path.join(tempfile.gettempdir(), "overlay.kml")
-                with open(ov_path, "wb") as f:
-                    f.write(z.read(kml))
-
     # ============================================================
-    # Run cached generator (no recomputation, no reload on download)
+    # Run cached generator (keyed on the uploaded bytes, so reruns hit the cache)
     # ============================================================
-    outputs = generate_all_outputs(
-        aoi_path, ov_path,
-        st.session_state["user_inputs"],
-        cell_size, title_text, density, area_invasive
-    )
+    aoi_args = (uploaded_aoi.getvalue(), uploaded_aoi.name)
+    overlay_args = (overlay_file.getvalue(), overlay_file.name) if overlay_file else (None, None)
+    outputs = generate_all_outputs(*aoi_args, *overlay_args, cell_size)
     for k, v in outputs.items():
         st.session_state[k] = v
 
@@ -510,31 +766,31 @@ if st.session_state.get("generated", False):
     # ============================================================
     m = folium.Map(location=[11, 78.5], zoom_start=8)
 
-    gdf_for_bounds = read_kml_safely(aoi_path)
-    aoi_union = unary_union(gdf_for_bounds.geometry)
+    # AOI outline = polygons already merged by the cached grid step
+    aoi_union = st.session_state["merged_ll"]
+    # Vertices closer than ~1/20 of a cell can't be seen in the preview, so don't ship them
+    preview_tol = cell_size / 111_320 / 20
 
     # AOI boundary
     folium.GeoJson(
-        mapping(aoi_union),
+        mapping(shapely.simplify(aoi_union, preview_tol, preserve_topology=False)),
         style_function=lambda x: {"color": "red", "weight": 3, "fillOpacity": 0}
     ).add_to(m)
 
-    # Grid cells
-    for c in st.session_state["cells_ll"]:
-        folium.GeoJson(
-            mapping(c),
-            style_function=lambda x: {"color": "red", "weight": 1, "fillOpacity": 0}
-        ).add_to(m)
+    # Grid cells (one layer for the whole grid)
+    folium.GeoJson(
+        _feature_collection(_preview_geoms(st.session_state["cells_ll"], preview_tol)),
+        name="Grid",
+        style_function=lambda x: {"color": "red", "weight": 1, "fillOpacity": 0}
+    ).add_to(m)
 
     # Overlay
     if st.session_state["overlay_gdf"] is not None and not st.session_state["overlay_gdf"].empty:
-        for g in st.session_state["overlay_gdf"].geometry:
-            if g.is_empty:
-                continue
-            folium.GeoJson(
-                mapping(g),
-                style_function=lambda x: {"color": "#FFD700", "weight": 3, "fillOpacity": 0}
-            ).add_to(m)
+        folium.GeoJson(
+            _feature_collection(_preview_geoms(st.session_state["overlay_gdf"].geometry, preview_tol)),
+            name="Overlay",
+            style_function=lambda x: {"color": "#FFD700", "weight": 3, "fillOpacity": 0}
+        ).add_to(m)
 
     # Fit bounds and display
     bounds = [
@@ -550,25 +806,29 @@ if st.session_state.get("generated", False):
     st.markdown("### 💾 Downloads")
     c1, c2, c3 = st.columns(3)
 
+    prepared = st.session_state.setdefault("prepared", set())
+
     with c1:
-        st.download_button(
-            "📦 Download Grid Only KML",
-            st.session_state["grid_only_kml"],
-            file_name="grid_only.kml",
-            mime="application/vnd.google-earth.kml+xml",
-        )
+        if "grid_only" in prepared or st.button("📦 Prepare Grid Only KML", key="btn_grid_only_kml"):
+            prepared.add("grid_only")
+            data, file_name, mime = grid_only_kml_output(*aoi_args, st.session_state["user_inputs"], cell_size)
+            st.download_button("📦 Download Grid Only KML", data, file_name=file_name, mime=mime)
     with c2:
-        st.download_button(
-            "🧾 Download Labeled + Overlay KML",
-            st.session_state["labeled_kml"],
-            file_name="merged_labeled.kml",
-            mime="application/vnd.google-earth.kml+xml",
-        )
+        if "labeled" in prepared or st.button("🧾 Prepare Labeled + Overlay KML", key="btn_labeled_kml"):
+            prepared.add("labeled")
+            data, file_name, mime = labeled_kml_output(
+                *aoi_args, *overlay_args, st.session_state["user_inputs"], cell_size
+            )
+            st.download_button("🧾 Download Labeled + Overlay KML", data, file_name=file_name, mime=mime)
     with c3:
-        if generate_pdf:
+        if generate_pdf and ("pdf" in prepared or st.button("📄 Prepare Invasive Report (PDF)", key="btn_pdf")):
+            prepared.add("pdf")
             st.download_button(
                 "📄 Download Invasive Report (PDF)",
-                st.session_state["pdf_bytes"],
+                pdf_report_output(
+                    *aoi_args, *overlay_args, st.session_state["user_inputs"],
+                    cell_size, title_text, density, area_invasive
+                ),
                 file_name="Invasive_Report.pdf",
                 mime="application/pdf",
             )